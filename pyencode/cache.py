@@ -1,14 +1,16 @@
 '''
-A simple cache class for downloading URLs to disk, if necessary.
+A simple cache class for downloading URLs to disk (or another storage), if necessary.
 
 Copyright 2014, Konstantin Tretyakov
 Licensed under MIT.
 '''
 import json
-import os
 import os.path
 import urllib
 
+from .scheduler import DownloadScheduler, DownloadFuture
+from .storage import DiskStorage
+
 class HttpException(Exception):
     pass
 
@@ -20,68 +22,136 @@ _urlopener = ErrorAwareURLOpener()
 
 
 class Cache(object):
-    '''A simple disk-based URL cache. Note that it is *not* safe for any kind of multithreading or multiprocessing (i.e. you should not use several instances with the same ``root_dir`` in parallel, as no locking of files is done to ensure correct operation).'''
+    '''A simple URL cache. Files are kept in a ``storage.Storage``, by default in a directory on disk.
+    Note that it is *not* safe for any kind of multithreading or multiprocessing (i.e. you should not use several instances with the same ``root_dir`` in parallel, as no locking of files is done to ensure correct operation).
+    The only exception are the downloads, performed by the ``scheduler``: those only become visible in storage when complete.'''
     
-    def __init__(self, root_dir, reporthook=None):
+    def __init__(self, root_dir, reporthook=None, scheduler=None, storage=None):
         '''
         Create the instance of a cache.
         
         Args:
-            root_dir (str): The root directory to store files. Will be created if not existing.
+            root_dir (str): The root directory to store files. Will be created if not existing (unless ``storage`` is given).
         KwArgs:
             reporthook (function):  A reporthook provided to ``urlopen`` for tracking download progress.
                 Must be a function ``(block_count, block_size, total_bytes)``, see ``urlretrieve`` documentation.
+            scheduler (scheduler.DownloadScheduler): When given, all downloads (including the ones by ``fetch_url``) are done via this scheduler.
+                Otherwise ``fetch_url`` downloads directly (unless the file is being downloaded by ``fetch_url_async`` already),
+                and a default scheduler is created for ``fetch_url_async`` on its first call.
+            storage (storage.Storage): Where to keep the files. Defaults to ``storage.DiskStorage(root_dir)``.
         Raises:
             WindowsError or IOError or other system errors: if cache directory cannot be created or written to
         '''
         self.root_dir = root_dir
         self.reporthook = reporthook
-        if not os.path.isdir(root_dir):
-            os.mkdir(root_dir)
+        self.scheduler = scheduler
+        self._default_scheduler = None
+        self._downloads = {}  # filename -> DownloadFuture, for downloads queued with the default scheduler
+        self.storage = storage if storage is not None else DiskStorage(root_dir)
     
-    def fetch_url(self, source_url, filename, force=False):
+    def fetch_url(self, source_url, filename, force=False, priority=0):
         '''
         Downloads the file from ``source_url`` into ``filename`` (under cache directory), unless ``filename`` already exists.
         
-        Returns the absolute path of ``filename``.
+        Returns the absolute path of ``filename`` (see ``local_path``).
         
         Args:
             source_url (str): Url to retrieve data from.
             filename (str): filename (relative to ``root_dir``) to store file to.
             force (bool): when True, the file will be redownloaded even if it is already available
+            priority (int): priority of the download, when done via ``scheduler``. Larger values are downloaded first.
         Raises:
-            Any exceptions that ``urllib.urlretrieve`` may raise.
+            Any exceptions that ``urllib.urlopen`` may raise.
+        '''
+        if self.scheduler is not None or filename in self._downloads:
+            return self.fetch_url_async(source_url, filename, force, priority).result()
+        if not self.storage.exists(filename) or force:
+            self._retrieve(source_url, filename)
+        return os.path.abspath(self.local_path(filename))
+    
+    def fetch_url_async(self, source_url, filename, force=False, priority=0, size=None):
         '''
-        target_file = self.local_path(filename)
-        if not os.path.isfile(target_file) or force:
-            target_dir = os.path.dirname(target_file)
-            if not os.path.exists(target_dir):
-                os.makedirs(target_dir)
-            (downloaded_filename, headers) = _urlopener.retrieve(source_url, target_file, reporthook=self.reporthook)
-        return os.path.abspath(target_file)
+        Same as ``fetch_url``, but queues the download with the ``scheduler`` and returns immediately.
+        
+        Returns a ``scheduler.DownloadFuture``, whose result is the absolute path of ``filename``.
+        Fetching a file that is already queued returns the future of that download (moving it forward, if ``priority`` is higher).
+        
+        Args:
+            source_url (str): Url to retrieve data from.
+            filename (str): filename (relative to ``root_dir``) to store file to.
+            force (bool): when True, the file will be redownloaded even if it is already available
+            priority (int): Larger values are downloaded first.
+            size (int): expected size of the file in bytes, if known. Among downloads with equal priority, smaller ones go first.
+        '''
+        if self.storage.exists(filename) and not force:
+            future = DownloadFuture()
+            future._set_result(os.path.abspath(self.local_path(filename)))
+            return future
+        if self.scheduler is not None:
+            return self.scheduler.submit(source_url, lambda throttle: self._retrieve(source_url, filename, throttle),
+                                         priority=priority, size=size, key=filename)
+        if self._default_scheduler is None:
+            self._default_scheduler = DownloadScheduler()
+        future = self._default_scheduler.submit(source_url, lambda throttle: self._retrieve(source_url, filename, throttle),
+                                                priority=priority, size=size, key=filename)
+        self._downloads[filename] = future
+        def forget(future):
+            if self._downloads.get(filename) is future:
+                del self._downloads[filename]
+        future.add_done_callback(forget)
+        return future
+    
+    def _retrieve(self, source_url, filename, throttle=None, block_size=8192):
+        '''Downloads ``source_url`` to ``filename`` in storage, calling ``throttle(n)`` (if given) for each block of ``n`` bytes.'''
+        fin = _urlopener.open(source_url)
+        try:
+            total_bytes = int(fin.info().get('Content-Length', -1))
+            block_count = 0
+            if self.reporthook:
+                self.reporthook(block_count, block_size, total_bytes)
+            with self.storage.create(filename) as fout:
+                while True:
+                    block = fin.read(block_size)
+                    if not block:
+                        break
+                    fout.write(block)
+                    if throttle is not None:
+                        throttle(len(block))
+                    block_count += 1
+                    if self.reporthook:
+                        self.reporthook(block_count, block_size, total_bytes)
+        finally:
+            fin.close()
+        return os.path.abspath(self.local_path(filename))
         
     def has_file(self, filename):
         '''Checks whether ``filename`` is present in cache.'''
-        return os.path.exists(os.path.join(self.root_dir, filename))
+        return self.storage.exists(filename)
+    
+    def open(self, filename):
+        '''Opens ``filename`` from cache for reading in binary. Will raise an exception, if file does not exist.'''
+        return self.storage.open(filename)
+    
+    def buffer(self, filename):
+        '''Returns the contents of ``filename`` in cache as a read-only buffer, memory-mapped where possible (see ``storage.Storage.buffer``).'''
+        return self.storage.buffer(filename)
     
     def local_path(self, filename):
-        '''Return the local path (not necessarily abspath) of a file as it (or would be) is stored in cache.'''
-        return os.path.join(self.root_dir, filename)
+        '''Return the local path (not necessarily abspath) of a file as it (or would be) is stored in cache.
+        Note that if the ``storage`` does not keep files on disk, the path is nominal.'''
+        path = self.storage.path(filename)
+        return path if path is not None else os.path.join(self.root_dir, filename)
     
     def json_dump(self, obj, filename):
         '''Dump ``obj`` to the ``filename`` in cache as JSON.'''
-        target_file = os.path.join(self.root_dir, filename)
-        target_dir = os.path.dirname(target_file)
-        if not os.path.exists(target_dir):
-            os.mkdirs(target_dir)
-        with open(target_file, 'wb') as f:
+        with self.storage.create(filename) as f:
             json.dump(obj, f)
     
     def json_load(self, filename):
         '''Load data from ``filename`` in cache as JSON.'''
-        with open(os.path.join(self.root_dir, filename), 'rb') as f:
+        with self.open(filename) as f:
             return json.load(f)
     
     def erase(self, filename):
         '''Deletes given file from cache. Will raise an exception, if file does not exist.'''
-        os.unlink(os.path.join(self.root_dir, filename))    
\ No newline at end of file
+        self.storage.remove(filename)
@@ -8,18 +8,54 @@ import gzip
 import json
 import os.path
 import re
+import shutil
 import urllib
+import zipfile
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from intervaltree_bio import GenomeIntervalTree
 
 from .cache import Cache
+from .storage import DiskStorage, SnapshotStorage
 from ._gzip import GzipInputStream
-from .util import with_closing_contextmanager
+from .util import with_closing_contextmanager, parse_size
 
 
+# File types that can be read as intervals
+_BED_TYPES = ['bed', 'narrowPeak', 'broadPeak']
+
 class EncodeException(Exception):
     pass
 
+def _parse_listing(content):
+    '''
+    Parse the directory listing page at the ENCODE root URL. Returns an ``OrderedDict``, mapping each collection name
+    to the rest of its listing line (i.e. the modification time and size of the directory, as shown by the server).
+    
+     >>> _parse_listing('<a href="wgEncodeAffyRnaChip/">wgEncodeAffyRnaChip/</a>     2012-10-04 13:26    -\\n'
+     ...                '<a href="wgEncodeUwTfbs/">wgEncodeUwTfbs/</a>   2012-06-12 08:41    -\\n')
+     OrderedDict([('AffyRnaChip', '2012-10-04 13:26    -'), ('UwTfbs', '2012-06-12 08:41    -')])
+    '''
+    p = re.compile('<a href="wgEncode([^"]+)/">[^<]*</a>([^\n<]*)')
+    return OrderedDict((name, stamp.strip()) for name, stamp in p.findall(content))
+
+class SyncResult(object):
+    '''The changes found by ``Encode.sync``.'''
+    
+    def __init__(self):
+        self.added_collections = []    # Names of collections that appeared in the listing
+        self.removed_collections = []  # Names of collections that disappeared from the listing
+        self.changed_collections = []  # Names of collections whose metadata was refetched
+        self.added = []                # EncodeFile objects that appeared in refetched collections
+        self.removed = []              # EncodeFile objects that are no longer listed
+        self.changed = []              # EncodeFile objects (new ones), whose md5sum changed
+        self.refetched = []            # EncodeFile objects, whose data was redownloaded into cache
+    
+    def __repr__(self):
+        return '<SyncResult: %d added, %d removed, %d changed files in %d changed collections>' % (
+                    len(self.added), len(self.removed), len(self.changed), len(self.changed_collections))
+
 class Encode(object):
     '''
     The root object, representing the hierarchy of ENCODE project data files.
@@ -29,7 +65,9 @@ class Encode(object):
     
     def __init__(self, cache_dir=os.path.expanduser("~/.pyencode"),
                          reporthook=None,
-                         root_url="http://hgdownload.cse.ucsc.edu/goldenPath/hg19/encodeDCC"):
+                         root_url="http://hgdownload.cse.ucsc.edu/goldenPath/hg19/encodeDCC",
+                         scheduler=None,
+                         storage=None):
         '''
         Initialize the Encode root object.
         
@@ -40,13 +78,57 @@ class Encode(object):
                 Must be a function ``(block_count, block_size, total_bytes)``, see ``urlretrieve`` documentation.
             root_url (str): The URL root of the ENCODE data. Normally, you should not change the default value.
                 Expect all kind of wrong things to happen if you provide a wrong URL here.
+            scheduler (scheduler.DownloadScheduler): When given, all downloads are done via this scheduler, which allows to
+                limit download bandwidth and concurrency. A default scheduler is created when needed by ``fetch_async``.
+            storage (storage.Storage): Where to keep cached files. Defaults to ``storage.DiskStorage(cache_dir)``.
+                Use ``storage.MemoryStorage()`` to avoid touching the disk.
                 
         Raises:
             HttpException: on network errors.
             WindowsError or IOError or other system errors: if cache directory cannot be created or written to
             EncodeException: on other errors
         '''
-        self._cache = Cache(cache_dir, reporthook)
+        self._setup(Cache(cache_dir, reporthook, scheduler, storage), root_url)
+    
+    @classmethod
+    def from_snapshot(cls, snapshot_path, cache_dir=None, reporthook=None, scheduler=None):
+        '''
+        Initialize the Encode root object from a snapshot bundle, written by ``export_snapshot``.
+        
+        The bundle is read in place (no unpacking). Collection listings and file metadata are served from the bundle,
+        so no network access is needed to browse the collections it contains. Data files that are not
+        in the bundle are downloaded (when ``fetch``-ed) to ``cache_dir`` as usual.
+        
+        Note that files in ``cache_dir`` take precedence over the bundled ones (this is how ``sync`` and ``fetch(force=True)``
+        update the snapshot data). Hence ``cache_dir`` should not be shared with another snapshot or with a regular ``Encode`` cache,
+        otherwise the metadata found there (``collections.json``, ``files.txt``) will be used instead of the one in the bundle.
+        
+        Args:
+            snapshot_path (str): Path to the snapshot bundle.
+        KwArgs:
+            cache_dir (str): The root directory for keeping files not available in the bundle.
+                Defaults to a separate directory next to the bundle, named ``<snapshot_path>.cache``.
+            reporthook (function): See ``__init__``.
+            scheduler (scheduler.DownloadScheduler): See ``__init__``.
+        
+        Raises:
+            zipfile.BadZipfile: if ``snapshot_path`` is not a valid bundle.
+            EncodeException: if the bundle does not look like a PyENCODE snapshot.
+            WindowsError or IOError or other system errors: if files cannot be read or cache directory cannot be created.
+        '''
+        if cache_dir is None:
+            cache_dir = '%s.cache' % snapshot_path
+        cache = Cache(cache_dir, reporthook, scheduler, SnapshotStorage(snapshot_path, DiskStorage(cache_dir)))
+        if not cache.has_file("snapshot.json"):
+            raise EncodeException("%s is not a PyENCODE snapshot" % snapshot_path)
+        manifest = cache.json_load("snapshot.json")
+        e = cls.__new__(cls)
+        e._setup(cache, manifest['root_url'])
+        return e
+    
+    def _setup(self, cache, root_url):
+        '''Initialization, common to __init__ and from_snapshot.'''
+        self._cache = cache
         self._root_url = root_url
         self._collections_names = self._read_collection_names()
         self._collections_list = [EncodeCollection(self, n) for n in self._collections_names]
@@ -57,12 +139,144 @@ class Encode(object):
     def _read_collection_names(self):
         '''Read a list of collections from the page at encode_root_url.'''
         if not self._cache.has_file("collections.json"):
-            file_name = self._cache.fetch_url(self._root_url, 'index.html')
-            file_content = open(file_name).read()
-            p = re.compile('<a href="wgEncode([^"]+)/">')
-            self._cache.json_dump(p.findall(file_content), "collections.json")
+            self._cache.fetch_url(self._root_url, 'index.html')
+            with self._cache.open('index.html') as f:
+                file_content = f.read()
+            self._cache.json_dump(list(_parse_listing(file_content)), "collections.json")
         return self._cache.json_load("collections.json")
     
+    def sync(self, refetch_data=False):
+        '''
+        Bring the cached metadata up to date with the server.
+        
+        Redownloads the listing at the ENCODE root URL and compares it with the cached one. The ``files.txt`` metadata
+        is then redownloaded only for the collections, which have it cached and whose directory modification time or size
+        in the listing has changed (if there was no cached listing, all collections with cached metadata are considered changed).
+        Files in those collections are compared by their ``md5sum``. Collections that were in the cached listing, but are
+        not among the collections of this object (e.g. those not exported to a snapshot) are ignored.
+        
+        The collections and files of this object are updated accordingly. Previously obtained
+        ``EncodeCollection`` and ``EncodeFile`` objects of changed collections should not be used after the call.
+        
+        The new listing and metadata replace the cached ones only after the metadata of all changed collections has been redownloaded,
+        so if the call fails halfway, the next call will find the same changes again.
+        
+        KwArgs:
+            refetch_data (bool): When True, changed files that are in cache are redownloaded.
+        Returns:
+            SyncResult
+        Raises:
+            HttpException: on network errors.
+        '''
+        result = SyncResult()
+        old_listing = {}
+        if self._cache.has_file('index.html'):
+            with self._cache.open('index.html') as f:
+                old_listing = _parse_listing(f.read())
+        self._cache.fetch_url(self._root_url, 'index.html.new', force=True)
+        with self._cache.open('index.html.new') as f:
+            new_listing = _parse_listing(f.read())
+        
+        for name in self._collections_names:
+            if name not in new_listing:
+                result.removed_collections.append(name)
+                c = self._collections_dict[name]
+                if c._files_list is not None or self._cache.has_file(c._files_txt_path):
+                    result.removed.extend(c)
+        
+        collections = []
+        changed = []
+        for name, stamp in new_listing.items():
+            c = self._collections_dict.get(name)
+            if c is None and name in old_listing:
+                continue  # Left out on purpose (see ``export_snapshot``)
+            if c is None:
+                result.added_collections.append(name)
+                c = EncodeCollection(self, name)
+            elif old_listing.get(name) != stamp and (c._files_list is not None or self._cache.has_file(c._files_txt_path)):
+                # The cached metadata is kept until the end, so that a failed call can be redone against it
+                self._cache.fetch_url('%s/files.txt' % c.url, '%s.new' % c._files_txt_path, force=True)
+                changed.append(c)
+            collections.append(c)
+        
+        # All metadata is downloaded, commit it along with the new listing
+        for c in changed:
+            result.changed_collections.append(c.name)
+            old_files = {f['filename']: f for f in c}
+            self._commit_new_file(c._files_txt_path)
+            c._reset()
+            for f in c:
+                old_f = old_files.pop(f['filename'], None)
+                if old_f is None:
+                    result.added.append(f)
+                elif old_f._attrs.get('md5sum') != f._attrs.get('md5sum'):
+                    result.changed.append(f)
+            result.removed.extend(old_files.values())
+        self._commit_new_file('index.html')
+        self._collections_names = [c.name for c in collections]
+        self._cache.json_dump(self._collections_names, "collections.json")
+        for name in result.removed_collections:
+            del self.__dict__[name]
+        for c in collections:
+            self.__dict__[c.name] = c
+        self._collections_list = collections
+        self._collections_dict = {c.name: c for c in collections}
+        
+        if refetch_data:
+            result.refetched = [f for f in result.changed if self._cache.has_file(f._cache_path)]
+            for future in [f.fetch_async(force=True) for f in result.refetched]:
+                future.result()
+        return result
+    
+    def _commit_new_file(self, filename):
+        '''Replaces ``filename`` in cache with ``<filename>.new``, downloaded by ``sync``.'''
+        with self._cache.open('%s.new' % filename) as fin:
+            with self._cache.storage.create(filename) as fout:
+                shutil.copyfileobj(fin, fout)
+        self._cache.erase('%s.new' % filename)
+    
+    def export_snapshot(self, snapshot_path, collections=None, include_data=False):
+        '''
+        Write a snapshot bundle, that can later be opened with ``Encode.from_snapshot`` (e.g. on a machine without network access).
+        
+        The bundle is a zip file, containing the list of collections, the ``files.txt`` metadata of each
+        of the chosen collections and, optionally, the data files of those collections, that are already in cache.
+        Metadata of the collections is downloaded if it is not in cache yet. Data files are never downloaded.
+        
+        Args:
+            snapshot_path (str): Path of the bundle file to write. Will be overwritten if it exists.
+        KwArgs:
+            collections (list): Names of collections to include. When None (default), all collections are included.
+                ``sync`` of an ``Encode`` object opened from the bundle keeps to the chosen collections (and the ones added on the server later).
+            include_data (bool): When True, data files of the chosen collections that are available in cache are added to the bundle.
+                Those are stored without further compression (most of them are gzipped already).
+        
+        Raises:
+            KeyError: if an unknown collection name is given.
+            HttpException: on network errors.
+        '''
+        if collections is None:
+            collections = self._collections_names
+        collections = [self[name] for name in collections]
+        with zipfile.ZipFile(snapshot_path, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as z:
+            z.writestr('snapshot.json', json.dumps({'root_url': self._root_url}))
+            z.writestr('collections.json', json.dumps([c.name for c in collections]))
+            if self._cache.has_file('index.html'):
+                with self._cache.open('index.html') as f:
+                    z.writestr('index.html', f.read())
+            for c in collections:
+                c._init()
+                with self._cache.open(c._files_txt_path) as f:
+                    z.writestr(c._files_txt_path, f.read())
+                if include_data:
+                    for f in c:
+                        path = self._cache.storage.path(f._cache_path)
+                        if path is not None and os.path.exists(path):
+                            z.write(path, f._cache_path, zipfile.ZIP_STORED)
+                        elif self._cache.has_file(f._cache_path):
+                            with self._cache.open(f._cache_path) as fin:
+                                z.writestr(zipfile.ZipInfo(f._cache_path), fin.read())
+    
     def __iter__(self):
         '''Iterates over all collections.'''
         for c in self._collections_list:
@@ -83,15 +297,16 @@ class EncodeCollection(object):
         self.name = name
         self.url = '%s/wgEncode%s' % (encode._root_url, name)
         self._cache_path = 'wgEncode%s' % name
+        self._files_txt_path = '%s/files.txt' % self._cache_path
     
     def _init(self):
         '''Read a list of files with metadata from the server.'''
         if self._files_list is not None:
             return
-        fn = self._encode._cache.fetch_url('%s/files.txt' % self.url, '%s/files.txt' % self._cache_path)
+        self._encode._cache.fetch_url('%s/files.txt' % self.url, self._files_txt_path)
         self._files_list = []
         self._files_dict = {}
-        with open(fn) as f:
+        with self._encode._cache.open(self._files_txt_path) as f:
             for ln in f:
                 # A line looks as follows:
                 # wgEncodeAwgSegmentationChromhmmGm12878.bed.gz<tab>project=wgEncode; composite=wgEncodeAwgSegmentation; dataType=Combined; cell=GM12878; dataVersion=ENCODE Jan 2011 Freeze; tableName=wgEncodeAwgSegmentationChromhmmGm12878; type=bed; size=9.9M
@@ -113,6 +328,13 @@ class EncodeCollection(object):
         for f in self._files_list:
             self.__dict__[f.name] = f
     
+    def _reset(self):
+        '''Forget the list of files, so that it is reread on next access.'''
+        if self._files_list is not None:
+            for name in self._files_dict:
+                del self.__dict__[name]
+        self._files_list = None
+    
     def _make_name_for_file(self, filename):
         '''Strip the wgEncodeBlabla prefix from the filename, to give a more concise "name" to a file to access it.
         This is somewhat hackish. Most collections consistently use the collection name as the file prefix,
@@ -136,6 +358,38 @@ class EncodeCollection(object):
             
         return filename[prefix_len:].split('.')[0]
     
+    def prefetch(self, priority=-1, force=False):
+        '''Queue all files of the collection for download into cache. Returns a list of ``scheduler.DownloadFuture`` objects, one per file.
+        
+        KwArgs:
+            priority (int): Priority of the downloads. The default is below the priority of ``fetch`` and ``fetch_async``,
+                so that those are not held up by the prefetch.
+            force (bool): When False (default), files already in cache are not redownloaded.
+        '''
+        return [f.fetch_async(force, priority) for f in self]
+    
+    def summaries(self, workers=1, bins=10):
+        '''
+        Computes ``EncodeFile.summary`` for all ``bed``-like files in the collection.
+        
+        KwArgs:
+            workers (int): Number of threads to compute the summaries in. Mostly useful when files are not in cache and are read from the web.
+            bins (int): See ``EncodeFile.summary``.
+        Returns:
+            an ``OrderedDict``, mapping file name to its summary.
+        '''
+        files = [f for f in self if f._attrs.get('type') in _BED_TYPES]
+        if workers > 1:
+            pool = ThreadPool(workers)
+            try:
+                results = pool.map(lambda f: f.summary(bins), files)
+            finally:
+                pool.terminate()
+                pool.join()
+        else:
+            results = [f.summary(bins) for f in files]
+        return OrderedDict((f.name, r) for f, r in zip(files, results))
+    
     def __getattr__(self, name):
         self._init()
         return self.__dict__[name]
@@ -182,29 +436,62 @@ class EncodeFile(object):
         Raises:
             Whatever ``urllib.urlretrieve`` may raise.
         '''
-        self._collection._encode._cache.fetch_url(self.url, self._cache_path)
+        self._collection._encode._cache.fetch_url(self.url, self._cache_path, force)
         return self
     
+    def fetch_async(self, force=False, priority=0):
+        '''Queue file for download into cache. Returns a ``scheduler.DownloadFuture``, whose result is the local path of the file.
+        
+        KwArgs:
+            force (bool): When False (default), the file will not be redownloaded if already in cache.
+            priority (int): Larger values are downloaded first. Among files with equal priority, smaller ones go first.
+        '''
+        size = parse_size(self._attrs['size']) if 'size' in self._attrs else None
+        return self._collection._encode._cache.fetch_url_async(self.url, self._cache_path, force, priority, size)
+    
     def open(self):
         '''Opens the file for reading in binary. If the file is available in cache, opens from cache. Otherwise opens via ``urlopen`` from the web without downloading to cache.'''
-        if os.path.exists(self.local_path):
-            return open(self.local_path, 'rb')
+        cache = self._collection._encode._cache
+        if cache.has_file(self._cache_path):
+            return cache.open(self._cache_path)
         else:
             return with_closing_contextmanager(urllib.urlopen(self.url))
     
     def open_text(self):
         '''Same as ``open``, but will open file in text mode. In addition, if the file is ``.gz``, will automatically unpack (i.e. will return the result of ``GzipFile.open``).'''
-        if os.path.exists(self.local_path):
-            if self.local_path.endswith('.gz'):
-                return gzip.open(self.local_path)
-            else:
-                return open(self.local_path, 'r')
+        cache = self._collection._encode._cache
+        if cache.has_file(self._cache_path):
+            path = cache.storage.path(self._cache_path)
+            if path is not None:
+                if path.endswith('.gz'):
+                    return gzip.open(path)
+                else:
+                    return open(path, 'r')
+            f = cache.open(self._cache_path)
+            if self._cache_path.endswith('.gz'):
+                f = GzipInputStream(fileobj=f)
+            return with_closing_contextmanager(f)
         else:
             f = urllib.urlopen(self.url)
             if self.url.endswith('.gz'):
                 f = GzipInputStream(fileobj=f)                
             return with_closing_contextmanager(f)
     
+    def open_mmap(self):
+        '''
+        Returns the contents of an uncompressed file in cache as a read-only buffer (a ``memoryview`` where possible),
+        memory-mapped rather than read, so that it can be scanned without copying (e.g. with ``re.finditer``).
+        
+        Raises:
+            EncodeException: if the file is compressed or is not in cache.
+        '''
+        if self._cache_path.endswith('.gz'):
+            raise EncodeException("%s is compressed, use open_text() instead" % self._attrs['filename'])
+        cache = self._collection._encode._cache
+        if not cache.has_file(self._cache_path):
+            raise EncodeException("%s is not in cache, fetch() it first" % self._attrs['filename'])
+        return cache.buffer(self._cache_path)
+    
     def read_as_intervaltree(self):
         '''
         Reads the data from a 'bed' file into an ``intervaltree_bio.GenomeIntervalTree`` data structure.
@@ -217,8 +504,61 @@ class EncodeFile(object):
         Returns:
             a GenomeIntervalTree instance.
         '''
-        assert self['type'] in ['bed', 'narrowPeak', 'broadPeak']
+        assert self['type'] in _BED_TYPES
         
         with self.open_text() as f:
             gtree = GenomeIntervalTree.from_bed(fileobj=f)
         return gtree
+    
+    def summary(self, bins=10):
+        '''
+        Computes summary statistics of a 'bed' file in a single pass over it, without keeping the intervals in memory.
+        Similarly to ``open`` and ``open_text`` it won't download file to cache, if it is not there.
+        
+        The result is stored in cache next to the file (keyed by the ``md5sum`` of the file, if it is known),
+        and subsequent calls return the stored copy.
+        
+        The file must be a `bed` or `bed.gz` file.
+        
+        KwArgs:
+            bins (int): Number of bins in the score histogram. The bins split evenly the range 0..1000 of ``bed`` scores.
+        Returns:
+            a dict with the following keys:
+                ``count`` - total number of intervals,
+                ``bases`` - total length of intervals (overlapping intervals are counted repeatedly),
+                ``chromosomes`` - a dict, mapping chromosome name to a dict with the ``count`` and ``bases`` of that chromosome,
+                ``score_histogram`` - a list with the number of intervals in each score bin (intervals without a score are not counted).
+        '''
+        assert self['type'] in _BED_TYPES
+        
+        cache = self._collection._encode._cache
+        summary_path = '%s.%s.%d.summary.json' % (self._cache_path, self._attrs['md5sum'], bins) if 'md5sum' in self._attrs else None
+        if summary_path is not None and cache.has_file(summary_path):
+            return cache.json_load(summary_path)
+        
+        chromosomes = {}
+        histogram = [0] * bins
+        with self.open_text() as f:
+            for ln in f:
+                if ln.startswith(('track', 'browser', '#')) or not ln.strip():
+                    continue
+                fields = ln.split('\t', 5)
+                length = int(fields[2]) - int(fields[1])
+                chrom = chromosomes.get(fields[0])
+                if chrom is None:
+                    chrom = chromosomes[fields[0]] = {'count': 0, 'bases': 0}
+                chrom['count'] += 1
+                chrom['bases'] += length
+                try:
+                    score = float(fields[4])
+                except (IndexError, ValueError):
+                    continue
+                histogram[max(0, min(int(score * bins / 1000), bins - 1))] += 1
+        
+        result = {'count': sum(c['count'] for c in chromosomes.values()),
+                  'bases': sum(c['bases'] for c in chromosomes.values()),
+                  'chromosomes': chromosomes,
+                  'score_histogram': histogram}
+        if summary_path is not None:
+            cache.json_dump(result, summary_path)
+        return result
@@ -0,0 +1,312 @@
+'''
+A download scheduler: a priority queue of downloads, processed by a pool of worker threads
+with concurrency caps and bandwidth limits (both global and per host).
+
+The scheduler itself does not know how to download anything. It runs *jobs*, i.e. functions
+``job(throttle)``, that are expected to call ``throttle(n)`` after transferring each ``n`` bytes.
+``cache.Cache`` provides such jobs, see ``Cache.fetch_url_async``.
+
+Copyright 2014, Konstantin Tretyakov
+Licensed under MIT.
+'''
+import heapq
+import itertools
+import sys
+import threading
+import time
+import urlparse
+
+
+class CancelledError(Exception):
+    pass
+
+class TimeoutError(Exception):
+    pass
+
+
+class DownloadFuture(object):
+    '''
+    The result of a scheduled download. Implements a subset of the ``concurrent.futures.Future`` interface.
+
+     >>> f = DownloadFuture()
+     >>> f.done()
+     False
+     >>> f._set_result('/tmp/x')
+     >>> f.done(), f.result()
+     (True, '/tmp/x')
+    '''
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._state = 'PENDING'
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def cancel(self):
+        '''Cancels the download, if it has not started yet. Returns True on success.'''
+        with self._condition:
+            if self._state == 'CANCELLED':
+                return True
+            if self._state != 'PENDING':
+                return False
+            self._state = 'CANCELLED'
+            self._condition.notify_all()
+        self._invoke_callbacks()
+        return True
+
+    def cancelled(self):
+        return self._state == 'CANCELLED'
+
+    def running(self):
+        return self._state == 'RUNNING'
+
+    def done(self):
+        return self._state in ('CANCELLED', 'FINISHED')
+
+    def result(self, timeout=None):
+        '''
+        Waits for the download to complete and returns the result of the job.
+
+        Raises:
+            CancelledError: if the download was cancelled.
+            TimeoutError: if the download did not complete within ``timeout`` seconds.
+            Whatever the job raised.
+        '''
+        self._wait(timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        '''Waits for the download to complete and returns the exception raised by the job (or None).'''
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info is not None else None
+
+    def add_done_callback(self, fn):
+        '''Invokes ``fn(future)`` when the download completes (immediately, if it is already complete).'''
+        with self._condition:
+            if not self.done():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self.done():
+                self._condition.wait(timeout)
+            if self._state == 'CANCELLED':
+                raise CancelledError()
+            if not self.done():
+                raise TimeoutError()
+
+    def _set_running(self):
+        '''Marks the future as running. Returns False if it was cancelled.'''
+        with self._condition:
+            if self._state != 'PENDING':
+                return False
+            self._state = 'RUNNING'
+            return True
+
+    def _set_result(self, result):
+        with self._condition:
+            self._result = result
+            self._state = 'FINISHED'
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+    def _set_exc_info(self, exc_info):
+        with self._condition:
+            self._exc_info = exc_info
+            self._state = 'FINISHED'
+            self._condition.notify_all()
+        self._invoke_callbacks()
+
+    def _invoke_callbacks(self):
+        callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            fn(self)
+
+
+class RateLimiter(object):
+    '''
+    A token bucket, limiting throughput to ``rate`` bytes per second on average.
+    Consumers are allowed to go into debt, and are then delayed until the debt is paid off.
+    '''
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self._tokens = self.rate
+        self._last = time.time()
+        self._lock = threading.Lock()
+
+    def consume(self, n):
+        '''Accounts for ``n`` transferred bytes, sleeping if the rate limit is exceeded.'''
+        with self._lock:
+            now = time.time()
+            self._tokens = min(self.rate, self._tokens + (now - self._last) * self.rate) - n
+            self._last = now
+            delay = -self._tokens / self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+
+class _Entry(object):
+    '''A queued download.'''
+    def __init__(self, host, job, future, key, priority):
+        self.host = host
+        self.priority = priority
+        self.job = job
+        self.future = future
+        self.key = key
+        self.stale = False
+
+
+class DownloadScheduler(object):
+    '''
+    Runs download jobs in a pool of worker threads, in the order of decreasing priority.
+    Among jobs with the same priority, smaller downloads go first (downloads of unknown size are assumed small).
+    
+    Running downloads are never interrupted. Instead, background downloads (those with negative priority) may not take
+    the last worker or the last slot of a host, so that downloads with priority 0 or higher can always start right away
+    (unless ``max_workers`` or ``max_per_host`` is 1, in which case nothing can be reserved).
+    
+    Worker threads exit once the queue is empty. Similarly to ``concurrent.futures``, the interpreter will
+    wait for queued downloads to complete before exiting.
+    '''
+
+    def __init__(self, max_workers=4, max_per_host=2, max_bytes_per_sec=None, max_host_bytes_per_sec=None):
+        '''
+        Create the scheduler. Worker threads are started as downloads are submitted.
+
+        KwArgs:
+            max_workers (int): Maximum number of simultaneous downloads.
+            max_per_host (int): Maximum number of simultaneous downloads from a single host.
+            max_bytes_per_sec (int): Limit on the total download rate. None means no limit.
+            max_host_bytes_per_sec (int): Limit on the download rate from a single host. None means no limit.
+        '''
+        self.max_workers = max_workers
+        self.max_per_host = max_per_host
+        self.max_host_bytes_per_sec = max_host_bytes_per_sec
+        self._limiter = RateLimiter(max_bytes_per_sec) if max_bytes_per_sec else None
+        self._host_limiters = {}
+        self._host_active = {}
+        self._active = 0
+        self._queue = []
+        self._queued = {}
+        self._counter = itertools.count()
+        self._condition = threading.Condition()
+        self._workers = []
+        self._idle = 0
+        self._shutdown = False
+
+    def submit(self, url, job, priority=0, size=None, key=None):
+        '''
+        Queue a download job.
+
+        Args:
+            url (str): The URL being downloaded. Its host is used for per-host limits.
+            job (function): A function ``job(throttle)``, performing the download. Its return value becomes the result of the future.
+        KwArgs:
+            priority (int): Larger values are downloaded first.
+            size (int): Expected size of the download in bytes, if known.
+            key (str): If given, and a download with the same key is already queued or running, its future is returned instead
+                of queueing a new download. A still queued download is moved forward if ``priority`` is higher than its original one.
+        Returns:
+            DownloadFuture
+        Raises:
+            RuntimeError: if the scheduler has been shut down.
+        '''
+        with self._condition:
+            if self._shutdown:
+                raise RuntimeError("Cannot submit downloads after shutdown")
+            existing = self._queued.get(key) if key is not None else None
+            if existing is not None and not existing[0].future.done():
+                old_entry, old_priority = existing
+                if old_entry.future.running() or priority <= old_priority:
+                    return old_entry.future
+                old_entry.stale = True
+                entry = _Entry(old_entry.host, old_entry.job, old_entry.future, key, priority)
+            else:
+                entry = _Entry(urlparse.urlsplit(url).netloc, job, DownloadFuture(), key, priority)
+            if key is not None:
+                self._queued[key] = (entry, priority)
+            heapq.heappush(self._queue, (-priority, size or 0, next(self._counter), entry))
+            if self._idle == 0 and len(self._workers) < self.max_workers:
+                t = threading.Thread(target=self._work)
+                t.start()
+                self._workers.append(t)
+            self._condition.notify()
+        return entry.future
+
+    def shutdown(self, wait=True):
+        '''Stops accepting new downloads. Queued downloads are still completed. If ``wait`` is True, waits for that to happen.'''
+        with self._condition:
+            self._shutdown = True
+            self._condition.notify_all()
+        if wait:
+            for t in list(self._workers):
+                t.join()
+
+    def _throttle(self, host, n):
+        if self._limiter is not None:
+            self._limiter.consume(n)
+        if self.max_host_bytes_per_sec:
+            with self._condition:
+                limiter = self._host_limiters.get(host)
+                if limiter is None:
+                    limiter = self._host_limiters[host] = RateLimiter(self.max_host_bytes_per_sec)
+            limiter.consume(n)
+
+    def _can_start(self, entry):
+        '''Checks the concurrency caps for ``entry``, keeping a slot reserved for non-background downloads. Must be called with the lock held.'''
+        reserved = 1 if entry.priority < 0 else 0
+        return (self._active < max(1, self.max_workers - reserved) and
+                self._host_active.get(entry.host, 0) < max(1, self.max_per_host - reserved))
+
+    def _pop(self):
+        '''Pops the first queued entry that can be started within the concurrency caps. Must be called with the lock held.'''
+        postponed = []
+        result = None
+        while self._queue:
+            item = heapq.heappop(self._queue)
+            entry = item[-1]
+            if entry.stale or entry.future.done():
+                continue
+            if not self._can_start(entry):
+                postponed.append(item)
+                continue
+            result = entry
+            break
+        for item in postponed:
+            heapq.heappush(self._queue, item)
+        return result
+
+    def _work(self):
+        while True:
+            with self._condition:
+                entry = self._pop()
+                while entry is None:
+                    if not self._queue:
+                        self._workers.remove(threading.current_thread())
+                        return
+                    self._idle += 1
+                    self._condition.wait()
+                    self._idle -= 1
+                    entry = self._pop()
+                self._host_active[entry.host] = self._host_active.get(entry.host, 0) + 1
+                self._active += 1
+                running = entry.future._set_running()
+            if running:
+                try:
+                    result = entry.job(lambda n, host=entry.host: self._throttle(host, n))
+                except BaseException:
+                    entry.future._set_exc_info(sys.exc_info())
+                else:
+                    entry.future._set_result(result)
+            with self._condition:
+                self._host_active[entry.host] -= 1
+                self._active -= 1
+                if entry.key is not None and self._queued.get(entry.key, (None,))[0] is entry:
+                    del self._queued[entry.key]
+                self._condition.notify_all()
@@ -0,0 +1,243 @@
+'''
+Storage backends for ``cache.Cache``: a directory on disk (the default), memory, and a read-only snapshot bundle.
+
+Files are addressed by relative names with ``/`` as separator (e.g. ``wgEncodeAwgSegmentation/files.txt``).
+
+Copyright 2014, Konstantin Tretyakov
+Licensed under MIT.
+'''
+import io
+import mmap
+import os
+import os.path
+import struct
+import threading
+import zipfile
+
+
+def _zero_copy(obj, offset=0, size=None):
+    '''Returns a read-only view of (a part of) a buffer-like object without copying it.
+    A ``memoryview`` where possible, otherwise (e.g. for ``mmap`` objects in Python 2) a ``buffer``.
+
+     >>> v = _zero_copy(b'abcdef', 2, 3)
+     >>> v.tobytes()
+     'cde'
+    '''
+    if size is None:
+        size = len(obj) - offset
+    try:
+        return memoryview(obj)[offset:offset + size]
+    except TypeError:
+        return buffer(obj, offset, size)
+
+
+class Storage(object):
+    '''The interface of a storage backend.'''
+
+    def exists(self, filename):
+        '''Checks whether ``filename`` is present in storage.'''
+        raise NotImplementedError()
+
+    def open(self, filename):
+        '''Opens ``filename`` for reading in binary. Will raise an exception, if file does not exist.'''
+        raise NotImplementedError()
+
+    def create(self, filename):
+        '''Returns a file-like object for writing ``filename`` in binary.
+        The data becomes visible only after the object is closed. When used as a context manager and an exception is raised, the data is discarded.'''
+        raise NotImplementedError()
+
+    def remove(self, filename):
+        '''Deletes given file. Will raise an exception, if file does not exist.'''
+        raise NotImplementedError()
+
+    def path(self, filename):
+        '''Returns the path on disk where ``filename`` is (or would be) stored as a plain file, or None if the storage does not keep it that way.'''
+        return None
+
+    def buffer(self, filename):
+        '''Returns the contents of ``filename`` as a read-only buffer (see ``_zero_copy``), avoiding copying data where possible.'''
+        with self.open(filename) as f:
+            return _zero_copy(f.read())
+
+
+class _PendingFile(object):
+    '''A file-like object for ``Storage.create``. Subclasses implement ``_commit`` and ``_discard``.'''
+
+    closed = False
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._commit()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif not self.closed:
+            self.closed = True
+            self._discard()
+
+
+class _DiskPendingFile(_PendingFile):
+    '''Writes to a temporary file, which is renamed to the target on close.
+    The temporary file is named after the writing process and thread, so that simultaneous writes of the same file do not clash.'''
+
+    def __init__(self, target_file):
+        self._target_file = target_file
+        self._tmp_file = '%s.%d-%d.part' % (target_file, os.getpid(), threading.current_thread().ident)
+        self._file = open(self._tmp_file, 'wb')
+        self.write = self._file.write
+
+    def _commit(self):
+        self._file.close()
+        if os.path.exists(self._target_file):
+            os.unlink(self._target_file)  # os.rename does not overwrite on Windows
+        os.rename(self._tmp_file, self._target_file)
+
+    def _discard(self):
+        self._file.close()
+        os.unlink(self._tmp_file)
+
+
+class DiskStorage(Storage):
+    '''Keeps files under ``root_dir``.'''
+
+    def __init__(self, root_dir):
+        '''
+        Args:
+            root_dir (str): The root directory to store files. Will be created if not existing.
+        Raises:
+            WindowsError or IOError or other system errors: if directory cannot be created
+        '''
+        self.root_dir = root_dir
+        if not os.path.isdir(root_dir):
+            os.mkdir(root_dir)
+
+    def exists(self, filename):
+        return os.path.exists(self.path(filename))
+
+    def open(self, filename):
+        return open(self.path(filename), 'rb')
+
+    def create(self, filename):
+        target_file = self.path(filename)
+        target_dir = os.path.dirname(target_file)
+        try:
+            os.makedirs(target_dir)
+        except OSError:
+            if not os.path.isdir(target_dir):
+                raise
+        return _DiskPendingFile(target_file)
+
+    def remove(self, filename):
+        os.unlink(self.path(filename))
+
+    def path(self, filename):
+        return os.path.join(self.root_dir, filename)
+
+    def buffer(self, filename):
+        '''Returns the file memory-mapped.'''
+        with self.open(filename) as f:
+            try:
+                m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:  # Empty files cannot be mapped
+                return _zero_copy(b'')
+        return _zero_copy(m)
+
+
+class _MemoryPendingFile(_PendingFile):
+
+    def __init__(self, files, filename):
+        self._files = files
+        self._filename = filename
+        self._data = io.BytesIO()
+        self.write = self._data.write
+
+    def _commit(self):
+        self._files[self._filename] = self._data.getvalue()
+
+    def _discard(self):
+        pass
+
+
+class MemoryStorage(Storage):
+    '''Keeps files in memory. Useful for tests and for small, frequently used files.'''
+
+    def __init__(self):
+        self._files = {}
+
+    def exists(self, filename):
+        return filename in self._files
+
+    def open(self, filename):
+        return io.BytesIO(self._files[filename])
+
+    def create(self, filename):
+        return _MemoryPendingFile(self._files, filename)
+
+    def remove(self, filename):
+        del self._files[filename]
+
+    def buffer(self, filename):
+        return _zero_copy(self._files[filename])
+
+
+class SnapshotStorage(Storage):
+    '''
+    A read-only snapshot bundle (a zip file, as written by ``Encode.export_snapshot``), layered over another storage.
+
+    Files are read from the bundle directly, without unpacking it. Files written to this storage go to the underlying
+    storage and take precedence over the bundled copies.
+    '''
+
+    def __init__(self, snapshot_path, storage):
+        '''
+        Args:
+            snapshot_path (str): Path to the snapshot bundle.
+            storage (Storage): The storage to keep files that are not in the bundle.
+        Raises:
+            zipfile.BadZipfile: if ``snapshot_path`` is not a valid bundle.
+        '''
+        self.snapshot_path = snapshot_path
+        self.storage = storage
+        self._zip = zipfile.ZipFile(snapshot_path, 'r')
+        self._members = set(self._zip.namelist())
+        self._mmap = None
+
+    def _bundled(self, filename):
+        return filename in self._members and not self.storage.exists(filename)
+
+    def exists(self, filename):
+        return filename in self._members or self.storage.exists(filename)
+
+    def open(self, filename):
+        if self._bundled(filename):
+            return self._zip.open(filename)
+        return self.storage.open(filename)
+
+    def create(self, filename):
+        return self.storage.create(filename)
+
+    def remove(self, filename):
+        self.storage.remove(filename)
+
+    def path(self, filename):
+        return None if self._bundled(filename) else self.storage.path(filename)
+
+    def buffer(self, filename):
+        '''Uncompressed members of the bundle are returned as parts of the memory-mapped bundle file.'''
+        if not self._bundled(filename):
+            return self.storage.buffer(filename)
+        info = self._zip.getinfo(filename)
+        if info.compress_type != zipfile.ZIP_STORED or info.file_size == 0:
+            return Storage.buffer(self, filename)
+        if self._mmap is None:
+            with open(self.snapshot_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # The local file header is 30 bytes, followed by the file name and the "extra" field (whose lengths are at offsets 26 and 28)
+        name_length, extra_length = struct.unpack('<HH', self._mmap[info.header_offset + 26:info.header_offset + 30])
+        return _zero_copy(self._mmap, info.header_offset + 30 + name_length + extra_length, info.file_size)
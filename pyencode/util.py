@@ -31,3 +31,19 @@ def with_closing_contextmanager(obj):
     obj.__exit__ = types.MethodType(lambda self, exc_type, exc_value, traceback: self.close(), obj)
     return obj
 
+def parse_size(size):
+    '''Converts a human-readable file size, as used in ENCODE ``files.txt`` (e.g. ``9.9M``), to a number of bytes.
+    
+     >>> parse_size('9.9M')
+     10380902
+     >>> parse_size('512')
+     512
+     
+    '''
+    multiplier = 1
+    if size[-1:].upper() in _SIZE_SUFFIXES:
+        multiplier = _SIZE_SUFFIXES[size[-1].upper()]
+        size = size[:-1]
+    return int(float(size) * multiplier)
+
+_SIZE_SUFFIXES = {'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
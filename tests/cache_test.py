@@ -5,7 +5,9 @@ Licensed under MIT
 import os
 import pytest
 import shutil
+import zipfile
 from pyencode.cache import Cache
+from pyencode.storage import DiskStorage, MemoryStorage, SnapshotStorage
 
 def test_root_dir(tmpdir):
     # No cachedir exists --> dir created
@@ -75,3 +77,42 @@ def test_fetch_url_json(tmpdir):
     c.erase('x.json')
     assert not c.has_file('x.json')
     c.erase('a.tmp')
+
+def test_memory_storage(tmpdir):
+    SOURCE = str(tmpdir.join('source.txt'))
+    with open(SOURCE, 'w') as f:
+        f.write('x' * 100000)
+    CACHE_DIR = str(tmpdir.join('cache'))
+    c = Cache(CACHE_DIR, storage=MemoryStorage())
+    c.fetch_url('file://' + SOURCE, 'a/b.txt')
+    assert c.has_file('a/b.txt')
+    with c.open('a/b.txt') as f:
+        assert f.read() == 'x' * 100000
+    c.json_dump([1, 2], 'x.json')
+    assert c.json_load('x.json') == [1, 2]
+    c.erase('x.json')
+    assert not c.has_file('x.json')
+    assert not os.path.exists(CACHE_DIR)
+
+def test_snapshot_storage(tmpdir):
+    CACHE_DIR = str(tmpdir.join('cache'))
+    SNAPSHOT = str(tmpdir.join('snapshot.zip'))
+    with zipfile.ZipFile(SNAPSHOT, 'w') as z:
+        z.writestr('x.json', '["a", "b"]')
+        z.writestr('a/b.txt', 'bundled')
+    c = Cache(CACHE_DIR, storage=SnapshotStorage(SNAPSHOT, DiskStorage(CACHE_DIR)))
+    
+    # Bundled files are read without unpacking and are not downloaded
+    assert c.has_file('x.json') and c.has_file('a/b.txt')
+    assert not c.has_file('y.json')
+    assert c.json_load('x.json') == ['a', 'b']
+    with c.open('a/b.txt') as f:
+        assert f.read() == 'bundled'
+    c.fetch_url('http://pyencode.invalid/', 'a/b.txt')
+    assert os.listdir(CACHE_DIR) == []
+    
+    # Files in cache directory take precedence over bundled ones
+    c.json_dump(['c'], 'x.json')
+    assert c.json_load('x.json') == ['c']
+    c.erase('x.json')
+    assert c.json_load('x.json') == ['a', 'b']
@@ -9,6 +9,7 @@ Copyright 2014, Konstantin Tretyakov
 Licensed under MIT
 '''
 from pyencode import Encode
+import gzip
 import os
 import pytest
 import shutil
@@ -112,6 +113,172 @@ def test_encode():
     assert result[0].begin == 249120411
     
 
+def test_sync(tmpdir):
+    e = Encode(str(tmpdir))
+    testFile = e.AwgTfbsUniform.HaibH1hescGabpPcr1xUniPk
+    
+    # Nothing changed
+    result = e.sync()
+    assert result.changed_collections == [] and result.changed == []
+    
+    # Simulate outdated cache: the collection is missing from the cached listing, one file is missing and one has a different md5sum
+    index = tmpdir.join('index.html')
+    index.write('\n'.join(ln for ln in index.read().split('\n') if 'wgEncodeAwgTfbsUniform/' not in ln))
+    files_txt = tmpdir.join('wgEncodeAwgTfbsUniform', 'files.txt')
+    lines = files_txt.read().split('\n')
+    lines = [ln.replace('md5sum=', 'md5sum=x') if ln.startswith(testFile['filename']) else ln for ln in lines[1:]]
+    files_txt.write('\n'.join(lines))
+    e = Encode(str(tmpdir))
+    
+    result = e.sync()
+    assert result.changed_collections == ['AwgTfbsUniform']
+    assert [f.name for f in result.changed] == ['HaibH1hescGabpPcr1xUniPk']
+    assert len(result.added) == 1 and result.removed == []
+    assert e.AwgTfbsUniform.HaibH1hescGabpPcr1xUniPk['md5sum'] == testFile['md5sum']
+
+
+def test_summary(tmpdir):
+    e = Encode(str(tmpdir))
+    testFile = e.AwgTfbsUniform.HaibH1hescGabpPcr1xUniPk
+    summary = testFile.summary()
+    itree = testFile.read_as_intervaltree()
+    assert summary['count'] == sum(len(itree[chrom]) for chrom in itree)
+    assert summary['count'] == sum(summary['score_histogram'])
+    assert summary['chromosomes']['chr1']['count'] == len(itree['chr1'])
+    assert summary['bases'] == sum(i.end - i.begin for chrom in itree for i in itree[chrom])
+    
+    # Result is cached
+    assert len(tmpdir.join('wgEncodeAwgTfbsUniform').listdir('*.summary.json')) == 1
+    assert testFile.summary() == summary
+
+
+# A root URL that can not be accessed, to make sure the offline tests do not use the network
+OFFLINE_URL = 'http://pyencode.invalid/encodeDCC'
+
+def _make_offline_cache(cache_dir):
+    '''Populates ``cache_dir`` as if ``Foo`` collection with a single file was fetched from the server.'''
+    cache_dir.ensure(dir=True)
+    cache_dir.join('index.html').write('<a href="wgEncodeFoo/">wgEncodeFoo/</a>   2012-01-01 10:00  -\n')
+    cache_dir.join('wgEncodeFoo').ensure(dir=True)
+    cache_dir.join('wgEncodeFoo', 'files.txt').write('wgEncodeFooA.bed.gz\tcell=K562; type=bed; md5sum=aaa; size=1K\n')
+    f = gzip.open(str(cache_dir.join('wgEncodeFoo', 'wgEncodeFooA.bed.gz')), 'wb')
+    f.write('chr1\t10\t20\tx\t500\n')
+    f.close()
+
+def test_snapshot(tmpdir):
+    _make_offline_cache(tmpdir.join('cache'))
+    e = Encode(str(tmpdir.join('cache')), root_url=OFFLINE_URL)
+    assert [c.name for c in e] == ['Foo']
+    SNAPSHOT = str(tmpdir.join('snapshot.zip'))
+    e.export_snapshot(SNAPSHOT, include_data=True)
+    
+    # Open into a default (new) cache directory
+    e = Encode.from_snapshot(SNAPSHOT)
+    assert e._cache.root_dir == SNAPSHOT + '.cache'
+    assert [c.name for c in e] == ['Foo']
+    assert [f.name for f in e.Foo] == ['A']
+    assert e.Foo.A['cell'] == 'K562'
+    with e.Foo.A.open_text() as f:
+        assert f.read() == 'chr1\t10\t20\tx\t500\n'
+    assert os.listdir(SNAPSHOT + '.cache') == []
+    
+    # Metadata in the cache directory takes precedence over the bundled one
+    tmpdir.join('stale').ensure(dir=True)
+    tmpdir.join('stale', 'collections.json').write('["Bar"]')
+    e = Encode.from_snapshot(SNAPSHOT, cache_dir=str(tmpdir.join('stale')))
+    assert [c.name for c in e] == ['Bar']
+
+
+def test_summaries_offline(tmpdir):
+    _make_offline_cache(tmpdir)
+    tmpdir.join('wgEncodeFoo', 'files.txt').write('wgEncodeFooA.bed.gz\ttype=bed; md5sum=aaa\n'
+                                                  'wgEncodeFooB.bed\ttype=narrowPeak; md5sum=bbb\n'
+                                                  'wgEncodeFooC.bam\ttype=bam; md5sum=ccc\n')
+    tmpdir.join('wgEncodeFoo', 'wgEncodeFooB.bed').write('track name=B\nchr1\t0\t100\tp\t1000\nchr2\t50\t60\tq\t250\nchr2\t5\t8\tr\t.\n')
+    e = Encode(str(tmpdir), root_url=OFFLINE_URL)
+    summaries = e.Foo.summaries(workers=2, bins=4)
+    assert list(summaries) == ['A', 'B']
+    assert summaries['A'] == e.Foo.A.summary(bins=4)
+    assert summaries['B']['count'] == 3 and summaries['B']['bases'] == 113
+    assert summaries['B']['chromosomes']['chr2'] == {'count': 2, 'bases': 13}
+    assert summaries['B']['score_histogram'] == [0, 1, 0, 1]
+    assert tmpdir.join('wgEncodeFoo', 'wgEncodeFooB.bed.bbb.4.summary.json').check()
+    
+    # Errors in workers are propagated
+    tmpdir.join('wgEncodeFoo', 'wgEncodeFooB.bed').write('chr1\tx\ty\n')
+    tmpdir.join('wgEncodeFoo', 'wgEncodeFooB.bed.bbb.4.summary.json').remove()
+    with pytest.raises(ValueError):
+        e.Foo.summaries(workers=2, bins=4)
+
+
+def _serve_offline(monkeypatch):
+    '''Makes ``file://`` URLs of directories return their ``index.html``, as a web server would.'''
+    from pyencode import cache
+    urlopen = cache._urlopener.open
+    monkeypatch.setattr(cache._urlopener, 'open', lambda url: urlopen(url + '/index.html' if os.path.isdir(url[len('file://'):]) else url))
+
+def test_sync_offline(tmpdir, monkeypatch):
+    _serve_offline(monkeypatch)
+    server = tmpdir.join('server')
+    _make_offline_cache(server)
+    server.join('index.html').write('<a href="wgEncodeFoo/">wgEncodeFoo/</a>   2012-01-01 10:00  -\n'
+                                    '<a href="wgEncodeBar/">wgEncodeBar/</a>   2012-01-01 10:00  -\n')
+    server.join('wgEncodeBar').ensure(dir=True)
+    server.join('wgEncodeBar', 'files.txt').write('wgEncodeBarX.bam\ttype=bam; md5sum=bbb\n')
+    e = Encode(str(tmpdir.join('cache')), root_url='file://' + str(server))
+    assert [f.name for f in e.Foo] == ['A'] and [f.name for f in e.Bar] == ['X']
+    e.Foo.A.fetch()
+    assert e.sync().changed_collections == []
+    
+    # Both collections change, but metadata of the second one can not be fetched
+    server.join('index.html').write('<a href="wgEncodeFoo/">wgEncodeFoo/</a>   2012-02-01 10:00  -\n'
+                                    '<a href="wgEncodeBar/">wgEncodeBar/</a>   2012-02-01 10:00  -\n')
+    server.join('wgEncodeFoo', 'files.txt').write('wgEncodeFooA.bed.gz\ttype=bed; md5sum=NEW\n'
+                                                  'wgEncodeFooA.bed.gz.tbi\ttype=tbi; md5sum=ccc\n')
+    f = gzip.open(str(server.join('wgEncodeFoo', 'wgEncodeFooA.bed.gz')), 'wb')
+    f.write('chr2\t10\t20\tx\t500\n')
+    f.close()
+    server.join('wgEncodeBar', 'files.txt').remove()
+    with pytest.raises(IOError):
+        e.sync()
+    assert '2012-01-01' in tmpdir.join('cache', 'index.html').read()
+    assert 'md5sum=aaa' in tmpdir.join('cache', 'wgEncodeFoo', 'files.txt').read()
+    
+    # Next sync finds the same changes (Foo has two files with the same name now)
+    server.join('wgEncodeBar', 'files.txt').write('wgEncodeBarX.bam\ttype=bam; md5sum=xxx\n')
+    result = e.sync(refetch_data=True)
+    assert result.changed_collections == ['Foo', 'Bar']
+    assert [f['filename'] for f in result.added] == ['wgEncodeFooA.bed.gz.tbi']
+    assert [f['filename'] for f in result.changed] == ['wgEncodeFooA.bed.gz', 'wgEncodeBarX.bam']
+    assert [f['filename'] for f in result.refetched] == ['wgEncodeFooA.bed.gz']
+    with result.refetched[0].open_text() as f:
+        assert f.read() == 'chr2\t10\t20\tx\t500\n'
+    assert '2012-02-01' in tmpdir.join('cache', 'index.html').read()
+    assert not tmpdir.join('cache', 'index.html.new').check()
+    assert not tmpdir.join('cache', 'wgEncodeFoo', 'files.txt.new').check()
+    assert e.sync().changed_collections == []
+
+def test_sync_snapshot(tmpdir, monkeypatch):
+    _serve_offline(monkeypatch)
+    server = tmpdir.join('server')
+    _make_offline_cache(server)
+    server.join('index.html').write('<a href="wgEncodeFoo/">wgEncodeFoo/</a>   2012-01-01 10:00  -\n'
+                                    '<a href="wgEncodeBar/">wgEncodeBar/</a>   2012-01-01 10:00  -\n')
+    e = Encode(str(tmpdir.join('cache')), root_url='file://' + str(server))
+    SNAPSHOT = str(tmpdir.join('snapshot.zip'))
+    e.export_snapshot(SNAPSHOT, collections=['Foo'])
+    
+    # Collections that were not exported are not reported as new
+    server.join('index.html').write('<a href="wgEncodeFoo/">wgEncodeFoo/</a>   2012-01-01 10:00  -\n'
+                                    '<a href="wgEncodeBar/">wgEncodeBar/</a>   2012-01-01 10:00  -\n'
+                                    '<a href="wgEncodeBaz/">wgEncodeBaz/</a>   2012-01-01 10:00  -\n')
+    e = Encode.from_snapshot(SNAPSHOT)
+    result = e.sync()
+    assert result.added_collections == ['Baz']
+    assert [c.name for c in e] == ['Foo', 'Baz']
+    assert Encode.from_snapshot(SNAPSHOT)._collections_names == ['Foo', 'Baz']
+
+
 def _test_promotorsearch():
     # Realistic example: find a promotor of a given gene ('NANOG', for example)
     # It is slow, so you don't want to run it too much.
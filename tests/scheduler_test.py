@@ -0,0 +1,113 @@
+'''
+Copyright 2014, Konstantin Tretyakov
+Licensed under MIT
+'''
+import os
+import threading
+import time
+import pytest
+from pyencode.cache import Cache
+from pyencode.scheduler import DownloadScheduler, CancelledError
+
+def test_priority_order():
+    s = DownloadScheduler(max_workers=1)
+    order = []
+    started, release = threading.Event(), threading.Event()
+    def blocker(throttle):
+        started.set()
+        release.wait()
+    def job(name):
+        return lambda throttle: order.append(name)
+
+    # Occupy the only worker, so that the rest are queued
+    s.submit('http://a/', blocker)
+    started.wait()
+    s.submit('http://a/', job('big'), size=5000)
+    s.submit('http://a/', job('small'), size=10)
+    s.submit('http://a/', job('urgent'), priority=1, size=10**9)
+    low = s.submit('http://a/', job('low'), priority=-1, key='low')
+    cancelled = s.submit('http://a/', job('cancelled'), priority=-2)
+    assert cancelled.cancel()
+
+    # Resubmitting with the same key moves the original download forward
+    assert s.submit('http://a/', job('low-again'), priority=2, key='low') is low
+    release.set()
+    s.shutdown()
+    assert order == ['low', 'urgent', 'small', 'big']
+    assert low.done() and not low.cancelled()
+    with pytest.raises(CancelledError):
+        cancelled.result()
+
+def test_reserved_slot():
+    s = DownloadScheduler()
+    release = threading.Event()
+    def background(throttle):
+        release.wait()
+        return 'background'
+    
+    # Long background downloads from the same host do not occupy all slots
+    background_futures = [s.submit('http://a/', background, priority=-1) for i in range(4)]
+    urgent = s.submit('http://a/', lambda throttle: 'urgent', priority=10)
+    assert urgent.result(timeout=5) == 'urgent'
+    assert not any(f.done() for f in background_futures)
+    assert sum(f.running() for f in background_futures) == 1
+    
+    # Same for downloads from different hosts
+    others = [s.submit('http://%d/' % i, background, priority=-1) for i in range(4)]
+    time.sleep(0.1)
+    assert sum(f.running() for f in background_futures + others) == 3
+    assert s.submit('http://b/', lambda throttle: 'urgent', priority=0).result(timeout=5) == 'urgent'
+    
+    release.set()
+    assert [f.result() for f in background_futures + others] == ['background'] * 8
+    s.shutdown()
+
+def test_errors_and_rate_limit():
+    s = DownloadScheduler(max_bytes_per_sec=1000)
+    def failing(throttle):
+        raise IOError("Oops")
+    assert isinstance(s.submit('http://a/', failing).exception(), IOError)
+
+    def transfer(throttle):
+        for i in range(3):
+            throttle(1000)
+        return 'done'
+    start = time.time()
+    assert s.submit('http://a/', transfer).result() == 'done'
+    assert time.time() - start >= 1.5
+    s.shutdown()
+
+def test_fetch_url_async(tmpdir):
+    SOURCE = str(tmpdir.join('source.txt'))
+    with open(SOURCE, 'w') as f:
+        f.write('x' * 100000)
+    c = Cache(str(tmpdir.join('cache')))
+    futures = [c.fetch_url_async('file://' + SOURCE, 'a/%d.txt' % i, priority=i) for i in range(5)]
+    for i, f in enumerate(futures):
+        assert f.result() == os.path.abspath(c.local_path('a/%d.txt' % i))
+        assert os.path.getsize(f.result()) == 100000
+    assert sorted(os.listdir(c.local_path('a'))) == ['%d.txt' % i for i in range(5)]
+
+    # The default scheduler is only used for asynchronous fetches
+    assert c.scheduler is None
+    assert c.fetch_url('file://' + SOURCE, 'b.txt') == os.path.abspath(c.local_path('b.txt'))
+    assert c.fetch_url_async('file://' + SOURCE, 'b.txt').done()
+
+def test_fetch_url_during_async(tmpdir):
+    SOURCE = str(tmpdir.join('source.txt'))
+    with open(SOURCE, 'w') as f:
+        f.write('x' * 100000)
+    started, release = threading.Event(), threading.Event()
+    def reporthook(block_count, block_size, total_bytes):
+        if threading.current_thread().name != 'MainThread':
+            started.set()
+            release.wait()
+    c = Cache(str(tmpdir.join('cache')), reporthook=reporthook)
+
+    # Fetching a file that is being downloaded in background waits for that download
+    future = c.fetch_url_async('file://' + SOURCE, 'a.txt', priority=-1)
+    started.wait()
+    threading.Timer(0.1, release.set).start()
+    assert c.fetch_url('file://' + SOURCE, 'a.txt') == future.result()
+    assert os.path.getsize(future.result()) == 100000
+    assert os.listdir(str(tmpdir.join('cache'))) == ['a.txt']
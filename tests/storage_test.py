@@ -0,0 +1,89 @@
+'''
+Copyright 2014, Konstantin Tretyakov
+Licensed under MIT
+'''
+import os
+import pytest
+import zipfile
+from pyencode.storage import DiskStorage, MemoryStorage, SnapshotStorage
+
+def _check_storage(s):
+    assert not s.exists('a/b.txt')
+    with s.create('a/b.txt') as f:
+        f.write('hello')
+        assert not s.exists('a/b.txt')   # Not visible until closed
+    assert s.exists('a/b.txt')
+    with s.open('a/b.txt') as f:
+        assert f.read() == 'hello'
+    assert s.buffer('a/b.txt')[1:3] == 'el'
+    
+    # Failed writes are discarded
+    with pytest.raises(ValueError):
+        with s.create('a/c.txt') as f:
+            f.write('oops')
+            raise ValueError()
+    assert not s.exists('a/c.txt')
+    
+    s.remove('a/b.txt')
+    assert not s.exists('a/b.txt')
+
+def test_disk_storage(tmpdir):
+    ROOT_DIR = str(tmpdir.join('cache'))
+    s = DiskStorage(ROOT_DIR)
+    assert os.path.isdir(ROOT_DIR)
+    _check_storage(s)
+    assert s.path('a/b.txt') == os.path.join(ROOT_DIR, 'a/b.txt')
+    assert os.listdir(os.path.join(ROOT_DIR, 'a')) == []
+    
+    with s.create('empty.txt') as f:
+        pass
+    assert len(s.buffer('empty.txt')) == 0
+
+def test_memory_storage():
+    s = MemoryStorage()
+    _check_storage(s)
+    assert s.path('a/b.txt') is None
+
+def test_snapshot_storage(tmpdir):
+    SNAPSHOT = str(tmpdir.join('snapshot.zip'))
+    with zipfile.ZipFile(SNAPSHOT, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr('x.json', '["a", "b"]')
+        z.writestr(zipfile.ZipInfo('a/stored.txt'), 'stored data')
+        info = zipfile.ZipInfo('a/with_extra_field.txt')
+        info.extra = '\xfe\xca\x04\x00abcd'
+        z.writestr(info, 'more stored data')
+    s = SnapshotStorage(SNAPSHOT, MemoryStorage())
+    _check_storage(s)
+    
+    # Bundled files are read without unpacking
+    assert s.exists('x.json') and s.exists('a/stored.txt')
+    with s.open('x.json') as f:
+        assert f.read() == '["a", "b"]'
+    with s.open('a/stored.txt') as f:
+        assert f.read() == 'stored data'
+    assert s.path('x.json') is None and s.path('a/stored.txt') is None
+    
+    # Deflated members are unpacked into memory, stored ones are sliced from the memory-mapped bundle
+    assert s.buffer('x.json')[:] == '["a", "b"]'
+    assert s._mmap is None
+    assert s.buffer('a/stored.txt')[:] == 'stored data'
+    assert s._mmap is not None
+    assert s.buffer('a/stored.txt')[7:9] == 'da'
+    assert s.buffer('a/with_extra_field.txt')[:] == 'more stored data'
+    
+    # Files written to the underlying storage take precedence over bundled ones
+    for name in ['x.json', 'a/stored.txt']:
+        with s.create(name) as f:
+            f.write('[]')
+        assert s.exists(name)
+        with s.open(name) as f:
+            assert f.read() == '[]'
+        assert s.buffer(name)[:] == '[]'
+        s.remove(name)
+    with s.open('x.json') as f:
+        assert f.read() == '["a", "b"]'
+    assert s.buffer('a/stored.txt')[:] == 'stored data'
+    
+    # Bundled files can not be removed
+    with pytest.raises(KeyError):
+        s.remove('x.json')